@@ -1,26 +1,34 @@
+import asyncio
 import os
 import logging
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from telegram.request import HTTPXRequest
 import json # Import json module
 import re   # Import re for regex parsing of admin commands
 
+try:
+    import orjson # Much faster C-based JSON, used when available
+except ImportError:
+    orjson = None
+
 # --- Web Server to satisfy Render's health checks ---
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b"OK")
-
-def run_web_server():
+# Runs on the bot's own event loop instead of a dedicated thread.
+async def _handle_health_request(reader, writer):
+    try:
+        await reader.read(1024) # Drain the request; its contents don't matter
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK")
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def run_health_server():
     port = int(os.environ.get("PORT", 8080))
-    server_address = ('', port)
-    httpd = HTTPServer(server_address, HealthCheckHandler)
-    logger.info(f"Starting simple web server for health checks on port {port}")
-    httpd.serve_forever()
+    server = await asyncio.start_server(_handle_health_request, '', port)
+    logger.info("Health check endpoint listening on port %s", port)
+    async with server:
+        await server.serve_forever()
 
 # --- Configuration ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -29,46 +37,201 @@ RAZORPAY_LINK = "https://razorpay.me/@gateprep" # Updated Payment Link
 USER_DATA_FILE = "user_ids.txt"
 COURSES_FILE = "courses.json" # File to store course data
 STATS_FILE = "bot_stats.json" # New: File to store bot statistics
+BROADCAST_CONCURRENCY = 25 # Stay below Telegram's ~30 msg/s global limit
+WEBHOOK_URL = os.environ.get("RENDER_EXTERNAL_URL") # Public URL Telegram can push updates to
+# Webhook mode is opt-in (USE_WEBHOOK=1 plus a public URL): PTB's webhook server
+# only exposes POST /<token> and answers nothing else with a 2xx, so it only
+# suits deployments whose health checks are TCP-only. The default stays polling
+# plus the GET / health endpoint below, which HTTP health-check paths can probe.
+USE_WEBHOOK = os.environ.get("USE_WEBHOOK") == "1" and bool(WEBHOOK_URL)
 
 # --- Logging Setup ---
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# Silence per-request debug spam from the HTTP client
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # --- Helper Functions for Data Persistence ---
 def load_json_data(filename, default_value={}):
     """Loads data from a JSON file."""
     try:
+        if orjson is not None:
+            with open(filename, 'rb') as f:
+                return orjson.loads(f.read())
         with open(filename, 'r') as f:
             return json.load(f)
     except FileNotFoundError:
-        logger.warning(f"{filename} not found. Creating with default value.")
+        logger.warning("%s not found. Creating with default value.", filename)
         save_json_data(filename, default_value)
         return default_value
-    except json.JSONDecodeError:
-        logger.error(f"Error decoding JSON from {filename}. Check file format. Returning default.")
+    except ValueError: # Covers both json.JSONDecodeError and orjson.JSONDecodeError
+        logger.error("Error decoding JSON from %s. Check file format. Returning default.", filename)
         return default_value
 
-def save_json_data(filename, data):
-    """Saves data to a JSON file."""
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=4)
+def save_json_data(filename, data, compact=False):
+    """Saves data to a JSON file atomically (write a temp file, then rename).
+
+    Serializes to one string/bytes object first so the file is written with a
+    single write call; compact=True drops indentation for hot-path writes.
+    """
+    tmp_filename = filename + ".tmp"
+    if orjson is not None:
+        payload = orjson.dumps(data) if compact else orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        with open(tmp_filename, 'wb') as f:
+            f.write(payload)
+    else:
+        payload = json.dumps(data, separators=(',', ':')) if compact else json.dumps(data, indent=4)
+        with open(tmp_filename, 'w') as f:
+            f.write(payload)
+    os.replace(tmp_filename, filename) # Never leaves a half-written file behind
 
 # Global variables for courses and stats
 GLOBAL_COURSES = load_json_data(COURSES_FILE, {})
 BOT_STATS = load_json_data(STATS_FILE, {"total_users": 0, "course_views": {}})
+# A Counter lets the click handler do a bare += 1 with no .get fallback;
+# it serializes back to JSON as a plain dict
+BOT_STATS['course_views'] = Counter(BOT_STATS.get('course_views') or {})
+
+# Known user IDs, loaded once at startup so /start never has to re-read the file
+def load_known_users():
+    """Loads all user IDs from the user data file into a set."""
+    try:
+        # Stream line by line: one pass, no whole-file string or split list
+        with open(USER_DATA_FILE, "r") as f:
+            return {int(line) for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+KNOWN_USERS = load_known_users()
+
+# Pending user IDs are coalesced into one append instead of open/write/close per user
+_pending_ids = []
+_flush_lock = asyncio.Lock()
+PENDING_IDS_LIMIT = 64  # flush early if a sign-up burst piles up
+USER_ID_FLUSH_INTERVAL = 5  # seconds
+
+def _append_user_ids(user_ids):
+    """Appends a batch of user IDs to the user data file (blocking, runs in a thread)."""
+    with open(USER_DATA_FILE, "a") as f:
+        f.write("".join(f"{uid}\n" for uid in user_ids))
+
+async def flush_user_ids():
+    """Writes all pending user IDs to disk in a single append."""
+    global _pending_ids
+    async with _flush_lock:
+        if not _pending_ids:
+            return
+        batch, _pending_ids = _pending_ids, []
+        try:
+            await asyncio.to_thread(_append_user_ids, batch)
+        except Exception as e:
+            # Put the batch back so the next flush retries it
+            _pending_ids = batch + _pending_ids
+            logger.error("Failed to append %s user IDs; will retry: %s", len(batch), e)
+
+async def user_id_flush_loop():
+    """Background task that periodically flushes pending user IDs."""
+    while True:
+        await asyncio.sleep(USER_ID_FLUSH_INTERVAL)
+        try:
+            await flush_user_ids()
+        except Exception as e: # Never let a transient error kill the flusher
+            logger.error("User ID flush failed; will retry: %s", e)
 
-# Helper for user IDs
-def save_user_id(user_id):
+async def save_user_id(user_id):
     """Saves a new user's ID for broadcasting, avoids duplicates and updates stats."""
-    with open(USER_DATA_FILE, "a+") as f:
-        f.seek(0)
-        user_ids = f.read().splitlines()
-        if str(user_id) not in user_ids:
-            f.write(str(user_id) + "\n")
-            BOT_STATS["total_users"] = len(user_ids) + 1 # Update count
-            save_json_data(STATS_FILE, BOT_STATS) # Save stats
+    if user_id in KNOWN_USERS:
+        return
+    KNOWN_USERS.add(user_id)
+    BOT_STATS["total_users"] = len(KNOWN_USERS) # Update count
+    mark_stats_dirty()
+    _pending_ids.append(user_id)
+    if len(_pending_ids) >= PENDING_IDS_LIMIT:
+        await flush_user_ids()
+
+# --- Debounced Stats Persistence ---
+# Stats mutations only mark the in-memory dict dirty; a background task
+# flushes to disk periodically instead of rewriting the file per event.
+_stats_dirty = asyncio.Event()
+STATS_FLUSH_INTERVAL = 5  # seconds a flush may lag behind the first mutation
+
+def mark_stats_dirty():
+    """Marks the in-memory stats as needing a flush to disk."""
+    _stats_dirty.set()
+
+async def flush_stats():
+    """Writes the stats file if anything changed since the last flush."""
+    if _stats_dirty.is_set():
+        _stats_dirty.clear()
+        try:
+            await asyncio.to_thread(save_json_data, STATS_FILE, BOT_STATS, compact=True)
+        except Exception as e:
+            _stats_dirty.set() # Keep the data marked dirty so the next cycle retries
+            logger.error("Failed to write stats; will retry: %s", e)
+
+async def stats_flush_loop():
+    """Background task that flushes stats shortly after they change."""
+    while True:
+        await _stats_dirty.wait() # Sleep until something actually changes
+        await asyncio.sleep(STATS_FLUSH_INTERVAL) # Let a burst of clicks coalesce
+        await flush_stats()
+
+# --- Cached Main Menu Keyboard ---
+# Rebuilt lazily instead of on every /start; invalidated when courses change.
+_main_menu_markup = None
+_course_texts = None # key -> (details text, buy text), rendered once per course change
+_buy_markups = None # key -> InlineKeyboardMarkup for the purchase screen
+
+def invalidate_course_caches():
+    """Drops all cached per-course objects so they are rebuilt on next use."""
+    global _main_menu_markup, _course_texts, _buy_markups
+    _main_menu_markup = None
+    _course_texts = None
+    _buy_markups = None
+
+def get_buy_markup(course_key):
+    """Returns the cached purchase keyboard for a course, or None."""
+    global _buy_markups
+    if _buy_markups is None:
+        _buy_markups = {
+            key: InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"💳 Pay ₹{course['price']} Now", url=RAZORPAY_LINK)],
+                [InlineKeyboardButton("✅ Share Payment Screenshot", callback_data="share_screenshot")],
+                [InlineKeyboardButton("⬅️ Back", callback_data=key)],
+            ])
+            for key, course in GLOBAL_COURSES.items()
+        }
+    return _buy_markups.get(course_key)
+
+def get_course_texts(course_key):
+    """Returns the pre-rendered (details, buy) texts for a course, or None."""
+    global _course_texts
+    if _course_texts is None:
+        _course_texts = {
+            key: (COURSE_DETAILS_TEXT.format(course_name=course['name']),
+                  BUY_COURSE_TEXT.format(course_name=course['name'], price=course['price']))
+            for key, course in GLOBAL_COURSES.items()
+        }
+    return _course_texts.get(course_key)
+
+def _course_label(course):
+    """Builds the button label for a course, including the Coming Soon suffix."""
+    label = f"{course['name']} - ₹{course['price']}"
+    if course['status'] == 'coming_soon':
+        label += " (Coming Soon)"
+    return label
+
+def get_main_menu_markup():
+    """Returns the main-menu keyboard, rebuilding it only if courses changed."""
+    global _main_menu_markup
+    if _main_menu_markup is None:
+        _main_menu_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(_course_label(course), callback_data=key)]
+             for key, course in GLOBAL_COURSES.items()]
+        )
+    return _main_menu_markup
 
 # --- Bot Texts & Data (Updated for clarity) ---
 COURSE_DETAILS_TEXT = """
@@ -137,30 +300,57 @@ ADMIN_HELP_TEXT = """
 _Statuses can be: `available` or `coming_soon`_
 """
 
+# Templates for messages forwarded to/from the admin; the constant parts are
+# interned once instead of being rebuilt by f-strings on every forward.
+FORWARD_TO_ADMIN_TEXT = (
+    "📩 New message from user: {name} (ID: {uid})\n"
+    "Regarding course: {course}\n\n"
+    "Message:\n{text}"
+)
+
+SCREENSHOT_CAPTION_TEXT = (
+    "📸 New payment screenshot from: {name} (ID: `{uid}`)\n"
+    "For course: **{course}**\n\n"
+    "Reply to this message to send the course link to the user."
+)
+
+FOLLOW_UP_TEXT = "↪️ Follow-up message from {name} (ID: {uid}):\n\n{text}"
+
 
 # --- Conversation States ---
 SELECTING_ACTION, FORWARD_TO_ADMIN, FORWARD_SCREENSHOT = range(3)
 
+# Extracts the user ID from forwarded messages; handles plain and backticked forms
+_ID_RE = re.compile(r"\(ID:\s*`?(\d+)`?\)")
+
+# Precompiled callback_data patterns, passed to the handlers once instead of
+# being recompiled from strings by PTB
+ACTION_PATTERN = re.compile(r"^(?:talk_admin|buy_course|share_screenshot)$")
+MAIN_MENU_PATTERN = re.compile(r"^main_menu$")
+
+def _is_course_key(callback_data):
+    """Predicate for the course-selection handler: only real course keys match."""
+    return callback_data in GLOBAL_COURSES
+
+# Admin-command argument parsing
+_SEMI_SPLIT = re.compile(r';\s*')
+# Course keys: anything outside [a-z0-9] maps to '_' via a C-level translate
+# table; runs of '_' are then collapsed on the (short) result
+_KEY_TBL = str.maketrans({c: '_' for c in map(chr, range(256)) if not ('a' <= c <= 'z' or '0' <= c <= '9')})
+_UNDERSCORE_RUN = re.compile(r'_+')
+
 # --- Command and Message Handlers ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles the /start command."""
     user = update.effective_user
     user_id = user.id
-    save_user_id(user_id) # This now updates BOT_STATS["total_users"]
-    logger.info(f"User {user.first_name} ({user_id}) started the bot.")
-    
-    keyboard = []
-    for key, course in GLOBAL_COURSES.items():
-        button_text = f"{course['name']} - ₹{course['price']}"
-        if course['status'] == 'coming_soon':
-            button_text += " (Coming Soon)"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=key)])
-        
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await save_user_id(user_id) # This now updates BOT_STATS["total_users"]
+    logger.info("User %s (%s) started the bot.", user.first_name, user_id)
+
     await update.message.reply_text(
         f"👋 Welcome, {user.first_name}!\n\nBrowse our Mechanical Engineering courses below. Select any course to see full details.\n\nFor questions, use the 'Talk to Admin' option inside any course, or use /help.",
-        reply_markup=reply_markup
+        reply_markup=get_main_menu_markup()
     )
     return SELECTING_ACTION
 
@@ -171,43 +361,29 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 # --- Admin Commands ---
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Displays the admin panel for authorized users."""
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("You are not authorized to use this command.")
-        return
     await update.message.reply_text(ADMIN_HELP_TEXT, parse_mode='Markdown')
 
 async def list_courses(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Lists all courses for the admin."""
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("You are not authorized to use this command.")
-        return
-    
-    global GLOBAL_COURSES
-    GLOBAL_COURSES = load_json_data(COURSES_FILE, {})
-
     if not GLOBAL_COURSES:
         await update.message.reply_text("No courses defined yet. Use `/addcourse` to add some!", parse_mode='Markdown')
         return
 
-    courses_info = "📚 **Current Courses:**\n\n"
+    parts = ["📚 **Current Courses:**\n"]
     for key, course in GLOBAL_COURSES.items():
-        courses_info += (
+        parts.append(
             f"**Key:** `{key}`\n"
             f"**Name:** {course['name']}\n"
             f"**Price:** ₹{course['price']}\n"
             f"**Status:** {course['status'].replace('_', ' ').title()}\n"
-            f"----------\n"
+            f"----------"
         )
-    await update.message.reply_text(courses_info, parse_mode='Markdown')
+    await update.message.reply_text("\n".join(parts), parse_mode='Markdown')
 
 async def add_course(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Admin command to add a new course."""
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("You are not authorized to use this command.")
-        return
-
     args_str = " ".join(context.args)
-    parts = [p.strip() for p in re.split(r';\s*', args_str)]
+    parts = [p.strip() for p in _SEMI_SPLIT.split(args_str)]
 
     if len(parts) != 3:
         await update.message.reply_text("Usage: `/addcourse <name>; <price>; <status>`", parse_mode='Markdown')
@@ -225,31 +401,31 @@ async def add_course(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         if price < 0:
             raise ValueError
     except ValueError:
-        await update.message.reply_text("❌ Invalid price. Please enter a positive number.", parse_mode='Markdown')
+        await update.message.reply_text("❌ Invalid price. Please enter a positive number.")
         return
     
-    key = re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+    key = _UNDERSCORE_RUN.sub('_', name.lower().translate(_KEY_TBL)).strip('_')
     if not key:
         key = f"course_{len(GLOBAL_COURSES) + 1}"
 
-    original_key = key
-    counter = 1
-    while key in GLOBAL_COURSES:
-        key = f"{original_key}_{counter}"
-        counter += 1
+    if key in GLOBAL_COURSES:
+        # One pass over existing keys instead of probing key_1, key_2, ... in turn
+        suffix_re = re.compile(rf"^{re.escape(key)}_(\d+)$")
+        max_suffix = max(
+            (int(m.group(1)) for k in GLOBAL_COURSES if (m := suffix_re.match(k))),
+            default=0,
+        )
+        key = f"{key}_{max_suffix + 1}"
 
     GLOBAL_COURSES[key] = {"name": name, "price": price, "status": status}
-    save_json_data(COURSES_FILE, GLOBAL_COURSES)
+    await asyncio.to_thread(save_json_data, COURSES_FILE, GLOBAL_COURSES)
+    invalidate_course_caches()
     await update.message.reply_text(f"✅ Course `{name}` (key: `{key}`) added successfully.", parse_mode='Markdown')
 
 async def edit_course(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Admin command to edit an existing course."""
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("You are not authorized to use this command.")
-        return
-
     args_str = " ".join(context.args)
-    parts = [p.strip() for p in re.split(r';\s*', args_str)]
+    parts = [p.strip() for p in _SEMI_SPLIT.split(args_str)]
 
     if len(parts) != 4:
         await update.message.reply_text("Usage: `/editcourse <key>; <new_name>; <new_price>; <new_status>`", parse_mode='Markdown')
@@ -269,21 +445,18 @@ async def edit_course(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         if new_price < 0:
             raise ValueError
     except ValueError:
-        await update.message.reply_text("❌ Invalid price. Please enter a positive number.", parse_mode='Markdown')
+        await update.message.reply_text("❌ Invalid price. Please enter a positive number.")
         return
     
     GLOBAL_COURSES[course_key]['name'] = new_name
     GLOBAL_COURSES[course_key]['price'] = new_price
     GLOBAL_COURSES[course_key]['status'] = new_status
-    save_json_data(COURSES_FILE, GLOBAL_COURSES)
+    await asyncio.to_thread(save_json_data, COURSES_FILE, GLOBAL_COURSES)
+    invalidate_course_caches()
     await update.message.reply_text(f"✅ Course `{course_key}` updated successfully.", parse_mode='Markdown')
 
 async def delete_course(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Admin command to delete a course."""
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("You are not authorized to use this command.")
-        return
-
     if len(context.args) != 1:
         await update.message.reply_text("Usage: `/delcourse <key>`", parse_mode='Markdown')
         return
@@ -295,30 +468,26 @@ async def delete_course(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     del GLOBAL_COURSES[course_key]
-    save_json_data(COURSES_FILE, GLOBAL_COURSES)
+    await asyncio.to_thread(save_json_data, COURSES_FILE, GLOBAL_COURSES)
+    invalidate_course_caches()
     await update.message.reply_text(f"✅ Course `{course_key}` deleted successfully.", parse_mode='Markdown')
 
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Admin command to show bot statistics."""
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("You are not authorized to use this command.")
-        return
-
-    global BOT_STATS
-    BOT_STATS = load_json_data(STATS_FILE, {"total_users": 0, "course_views": {}}) # Reload to get latest
-
-    stats_text = "📊 **Bot Statistics**\n\n"
-    stats_text += f"**Total Users:** `{BOT_STATS.get('total_users', 0)}`\n"
-    stats_text += "\n**Course Views:**\n"
+    parts = [
+        "📊 **Bot Statistics**\n",
+        f"**Total Users:** `{BOT_STATS.get('total_users', 0)}`\n",
+        "**Course Views:**",
+    ]
     if not BOT_STATS.get('course_views'):
-        stats_text += "  _No course views yet._\n"
+        parts.append("  _No course views yet._")
     else:
         sorted_views = sorted(BOT_STATS['course_views'].items(), key=lambda item: item[1], reverse=True)
         for course_key, views in sorted_views:
             course_name = GLOBAL_COURSES.get(course_key, {}).get('name', f'Unknown Course ({course_key})')
-            stats_text += f"  - {course_name}: `{views}` views\n"
-            
-    await update.message.reply_text(stats_text, parse_mode='Markdown')
+            parts.append(f"  - {course_name}: `{views}` views")
+
+    await update.message.reply_text("\n".join(parts), parse_mode='Markdown')
 
 
 async def course_selection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -330,11 +499,12 @@ async def course_selection_callback(update: Update, context: ContextTypes.DEFAUL
     if course_key in GLOBAL_COURSES:
         course = GLOBAL_COURSES[course_key]
         context.user_data['selected_course'] = course
+        context.user_data['selected_course_key'] = course_key
 
         # --- Track Course Views ---
         global BOT_STATS
-        BOT_STATS['course_views'][course_key] = BOT_STATS['course_views'].get(course_key, 0) + 1
-        save_json_data(STATS_FILE, BOT_STATS)
+        BOT_STATS['course_views'][course_key] += 1
+        mark_stats_dirty()
         # --- End Track Course Views ---
 
         if course['status'] == 'coming_soon':
@@ -351,7 +521,7 @@ async def course_selection_callback(update: Update, context: ContextTypes.DEFAUL
         
         reply_markup = InlineKeyboardMarkup(buttons)
         
-        course_details = COURSE_DETAILS_TEXT.format(course_name=course['name'])
+        course_details = get_course_texts(course_key)[0]
         await query.edit_message_text(text=course_details, reply_markup=reply_markup, parse_mode='Markdown')
     return SELECTING_ACTION
 
@@ -359,56 +529,55 @@ async def course_selection_callback(update: Update, context: ContextTypes.DEFAUL
 async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    keyboard = []
-    for key, course in GLOBAL_COURSES.items():
-        button_text = f"{course['name']} - ₹{course['price']}"
-        if course['status'] == 'coming_soon':
-            button_text += " (Coming Soon)"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=key)])
-        
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(
         text="Please select a course to view details:",
-        reply_markup=reply_markup
+        reply_markup=get_main_menu_markup()
     )
     return SELECTING_ACTION
 
 
+async def _action_talk_admin(query, context, course) -> int:
+    await query.edit_message_text(text="Please type your message and send it. I will forward it to the admin.")
+    return FORWARD_TO_ADMIN
+
+async def _action_buy_course(query, context, course) -> int:
+    course_key = context.user_data.get('selected_course_key', "main_menu")
+    reply_markup = get_buy_markup(course_key)
+    if reply_markup is None: # Course vanished since selection; fall back
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"💳 Pay ₹{course['price']} Now", url=RAZORPAY_LINK)],
+            [InlineKeyboardButton("✅ Share Payment Screenshot", callback_data="share_screenshot")],
+            [InlineKeyboardButton("⬅️ Back", callback_data=course_key)]
+        ])
+    texts = get_course_texts(course_key)
+    buy_text = texts[1] if texts else BUY_COURSE_TEXT.format(course_name=course['name'], price=course['price'])
+    await query.edit_message_text(text=buy_text, reply_markup=reply_markup)
+    return SELECTING_ACTION
+
+async def _action_share_screenshot(query, context, course) -> int:
+    await query.edit_message_text(text="Please send the screenshot of your payment now.")
+    return FORWARD_SCREENSHOT
+
+# O(1) dispatch table; new actions just add an entry here
+ACTION_HANDLERS = {
+    "talk_admin": _action_talk_admin,
+    "buy_course": _action_buy_course,
+    "share_screenshot": _action_share_screenshot,
+}
+
 async def handle_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    action = query.data
     course = context.user_data.get('selected_course')
 
     if not course:
         await query.edit_message_text("Something went wrong. Please start over by sending /start")
         return ConversationHandler.END
 
-    if action == "talk_admin":
-        await query.edit_message_text(text="Please type your message and send it. I will forward it to the admin.")
-        return FORWARD_TO_ADMIN
-    
-    elif action == "buy_course":
-        payment_link = RAZORPAY_LINK 
-        keyboard = [
-            [InlineKeyboardButton(f"💳 Pay ₹{course['price']} Now", url=payment_link)],
-            [InlineKeyboardButton("✅ Share Payment Screenshot", callback_data="share_screenshot")],
-            [InlineKeyboardButton("⬅️ Back", callback_data=course_key_from_name(course['name']))] 
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        buy_text = BUY_COURSE_TEXT.format(course_name=course['name'], price=course['price'])
-        await query.edit_message_text(text=buy_text, reply_markup=reply_markup)
+    handler = ACTION_HANDLERS.get(query.data)
+    if handler is None: # Can't happen while the dispatch pattern mirrors this table
         return SELECTING_ACTION
-
-    elif action == "share_screenshot":
-        await query.edit_message_text(text="Please send the screenshot of your payment now.")
-        return FORWARD_SCREENSHOT
-
-def course_key_from_name(course_name):
-    for key, course in GLOBAL_COURSES.items():
-        if course['name'] == course_name:
-            return key
-    return "main_menu" # Fallback if name not found
+    return await handler(query, context, course)
 
 # --- PARSE ERROR FIX: Removed parse_mode ---
 async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -416,10 +585,11 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user = update.effective_user
     course = context.user_data.get('selected_course', {'name': 'Not specified'})
     
-    forward_text = (
-        f"📩 New message from user: {user.first_name} {user.last_name or ''} (ID: {user.id})\n"
-        f"Regarding course: {course['name']}\n\n"
-        f"Message:\n{update.message.text}"
+    forward_text = FORWARD_TO_ADMIN_TEXT.format(
+        name=f"{user.first_name} {user.last_name or ''}",
+        uid=user.id,
+        course=course['name'],
+        text=update.message.text,
     )
     # Send as plain text to avoid parse errors from user input
     await context.bot.send_message(chat_id=ADMIN_ID, text=forward_text)
@@ -431,10 +601,10 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def forward_screenshot_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     course = context.user_data.get('selected_course', {'name': 'Not specified'})
-    caption = (
-        f"📸 New payment screenshot from: {user.first_name} {user.last_name or ''} (ID: `{user.id}`)\n"
-        f"For course: **{course['name']}**\n\n"
-        f"Reply to this message to send the course link to the user."
+    caption = SCREENSHOT_CAPTION_TEXT.format(
+        name=f"{user.first_name} {user.last_name or ''}",
+        uid=user.id,
+        course=course['name'],
     )
     await context.bot.send_photo(chat_id=ADMIN_ID, photo=update.message.photo[-1].file_id, caption=caption, parse_mode='Markdown')
     await update.message.reply_text("✅ Screenshot received! The admin will verify it and send you the course access link here soon.")
@@ -442,26 +612,19 @@ async def forward_screenshot_to_admin(update: Update, context: ContextTypes.DEFA
 
 async def reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles admin's reply to a forwarded message."""
-    if update.effective_user.id != ADMIN_ID:
-        return
     msg = update.effective_message
     if not msg.reply_to_message:
         await msg.reply_text("Please use the 'reply' feature on a forwarded user message.")
         return
     
     original_msg_text = msg.reply_to_message.text or msg.reply_to_message.caption
-    
-    if original_msg_text and "(ID: " in original_msg_text:
-        try:
-            user_id_str = original_msg_text.split("(ID: ")[1].split(")")[0].replace('`', '')
-            user_id = int(user_id_str)
-            
-            reply_text = f"Admin replied:\n\n{msg.text}\n\n---\n*You can reply to this message to continue the conversation.*"
-            await context.bot.send_message(chat_id=user_id, text=reply_text, parse_mode='Markdown')
-            await msg.reply_text("✅ Reply sent successfully.")
-        except (IndexError, ValueError) as e:
-            logger.error(f"Could not parse user ID from reply despite keyword match: {e}")
-            await msg.reply_text("❌ Error: Could not extract a valid user ID.")
+
+    match = _ID_RE.search(original_msg_text) if original_msg_text else None
+    if match:
+        user_id = int(match.group(1))
+        reply_text = f"Admin replied:\n\n{msg.text}\n\n---\n*You can reply to this message to continue the conversation.*"
+        await context.bot.send_message(chat_id=user_id, text=reply_text, parse_mode='Markdown')
+        await msg.reply_text("✅ Reply sent successfully.")
     else:
         await msg.reply_text("❌ Action failed. Make sure you are replying to the original forwarded message from a user.")
 
@@ -472,9 +635,9 @@ async def handle_user_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     replied_message = update.message.reply_to_message
 
     if replied_message and replied_message.from_user.is_bot and "Admin replied:" in replied_message.text:
-        logger.info(f"Forwarding follow-up reply from user {user.id} to admin.")
+        logger.info("Forwarding follow-up reply from user %s to admin.", user.id)
         
-        forward_text = f"↪️ Follow-up message from {user.first_name} (ID: {user.id}):\n\n{update.message.text}"
+        forward_text = FOLLOW_UP_TEXT.format(name=user.first_name, uid=user.id, text=update.message.text)
         
         # Send as plain text
         await context.bot.send_message(chat_id=ADMIN_ID, text=forward_text)
@@ -482,32 +645,50 @@ async def handle_user_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Admin command to broadcast a message to all users."""
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("You are not authorized to use this command.")
-        return
-
     message_to_broadcast = " ".join(context.args)
     if not message_to_broadcast:
         await update.message.reply_text("Usage: `/broadcast <your message>`", parse_mode='Markdown')
         return
         
-    try:
-        with open(USER_DATA_FILE, "r") as f:
-            user_ids = f.read().splitlines()
-    except FileNotFoundError:
-        await update.message.reply_text("User data file not found. No users to broadcast to.")
+    if not KNOWN_USERS:
+        await update.message.reply_text("No users to broadcast to yet.")
         return
 
+    # Feed IDs through a bounded queue into worker tasks, keeping concurrency
+    # under Telegram's ~30 msg/s limit. The in-memory KNOWN_USERS set is
+    # authoritative (it includes IDs not yet flushed to disk), so the user
+    # file is not touched at all.
+    queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
     sent_count = 0
     failed_count = 0
-    for user_id in user_ids:
-        try:
-            await context.bot.send_message(chat_id=int(user_id), text=message_to_broadcast)
-            sent_count += 1
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"Failed to send broadcast to {user_id}: {e}")
-            
+
+    async def send_worker():
+        nonlocal sent_count, failed_count
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            try:
+                # No parse_mode and no link preview: less server-side work per send
+                await context.bot.send_message(
+                    chat_id=user_id,
+                    text=message_to_broadcast,
+                    disable_web_page_preview=True,
+                )
+                sent_count += 1
+            except Exception as e:
+                logger.error("Failed to send broadcast to %s: %s", user_id, e)
+                failed_count += 1
+            # Pace each worker so the pool stays under ~30 msg/s overall
+            await asyncio.sleep(BROADCAST_CONCURRENCY / 30)
+
+    workers = [asyncio.create_task(send_worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    for user_id in list(KNOWN_USERS): # Snapshot: the set can grow mid-broadcast
+        await queue.put(user_id)
+    for _ in workers:
+        await queue.put(None) # Tell each worker to stop
+    await asyncio.gather(*workers)
+
     await update.message.reply_text(f"📢 Broadcast finished.\nSent: {sent_count}\nFailed: {failed_count}")
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -526,37 +707,57 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     try:
         await context.bot.send_message(chat_id=ADMIN_ID, text=error_message)
     except Exception as e:
-        logger.error(f"Failed to send error alert to admin: {e}")
+        logger.error("Failed to send error alert to admin: %s", e)
 
 async def main_menu_from_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """A helper to show main menu after a user sends a text/photo message."""
-    keyboard = []
-    for key, course in GLOBAL_COURSES.items():
-        button_text = f"{course['name']} - ₹{course['price']}"
-        if course['status'] == 'coming_soon':
-            button_text += " (Coming Soon)"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=key)])
-        
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         "You can select another course:",
-        reply_markup=reply_markup
+        reply_markup=get_main_menu_markup()
     )
     return SELECTING_ACTION
 
+# Handles for the background loops, kept so shutdown can cancel them cleanly
+_background_tasks = []
+
+async def on_startup(application) -> None:
+    """Kicks off background tasks once the event loop is running."""
+    # Plain asyncio tasks: Application.create_task warns when called from
+    # post_init (the application is not marked running yet)
+    _background_tasks.append(asyncio.create_task(user_id_flush_loop()))
+    _background_tasks.append(asyncio.create_task(stats_flush_loop()))
+    if not USE_WEBHOOK:
+        # In webhook mode PTB's own server owns the port and answers probes
+        _background_tasks.append(asyncio.create_task(run_health_server()))
+
+async def on_shutdown(application) -> None:
+    """Stops the background tasks and flushes any pending writes."""
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await flush_user_ids()
+    await flush_stats()
+
 def main() -> None:
     """Start the bot and the web server."""
     if not BOT_TOKEN or not ADMIN_ID:
         logger.error("FATAL: BOT_TOKEN or ADMIN_ID environment variables not set.")
         return
 
-    # Start web server in a background thread
-    web_thread = threading.Thread(target=run_web_server)
-    web_thread.daemon = True
-    web_thread.start()
-
-    # Start the Telegram bot
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Start the Telegram bot (the health server starts in on_startup).
+    # A bigger connection pool + HTTP/2 keeps broadcast fan-out from
+    # serializing on TLS handshakes.
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(HTTPXRequest(connection_pool_size=256, connect_timeout=5, read_timeout=20, http_version="2"))
+        .get_updates_request(HTTPXRequest(connection_pool_size=8, http_version="2"))
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # --- BUTTON LOGIC FIX: Handlers re-ordered ---
     conv_handler = ConversationHandler(
@@ -564,11 +765,11 @@ def main() -> None:
         states={
             SELECTING_ACTION: [
                 # Specific actions must come FIRST
-                CallbackQueryHandler(handle_action, pattern="^talk_admin$|^buy_course$|^share_screenshot$"),
-                CallbackQueryHandler(main_menu, pattern="^main_menu$"),
-                
-                # The general "course key" pattern must come LAST
-                CallbackQueryHandler(course_selection_callback, pattern="^[^_].*$"), # Matches any callback that doesn't start with _
+                CallbackQueryHandler(handle_action, pattern=ACTION_PATTERN),
+                CallbackQueryHandler(main_menu, pattern=MAIN_MENU_PATTERN),
+
+                # The general "course key" check must come LAST
+                CallbackQueryHandler(course_selection_callback, pattern=_is_course_key),
             ],
             FORWARD_TO_ADMIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, forward_to_admin)],
             FORWARD_SCREENSHOT: [MessageHandler(filters.PHOTO, forward_screenshot_to_admin)],
@@ -591,11 +792,28 @@ def main() -> None:
 
     application.add_handler(MessageHandler(filters.REPLY & filters.User(user_id=ADMIN_ID), reply_to_user))
     application.add_handler(MessageHandler(filters.REPLY & ~filters.COMMAND, handle_user_reply))
-    application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("broadcast", broadcast, filters=filters.User(ADMIN_ID)))
     application.add_error_handler(error_handler)
 
-    logger.info("Starting Telegram bot polling...")
-    application.run_polling()
+    if USE_WEBHOOK:
+        # Telegram pushes updates to us: no idle getUpdates polling at all
+        logger.info("Starting Telegram bot webhook server...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.environ.get("PORT", 8080)),
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+        )
+    else:
+        # Long poll: hold getUpdates open for up to 50s (the server-side max)
+        # instead of hammering short requests, and skip the inter-poll sleep
+        logger.info("Starting Telegram bot polling...")
+        application.run_polling(
+            timeout=50,
+            poll_interval=0,
+            bootstrap_retries=-1,
+            allowed_updates=Update.ALL_TYPES,
+        )
 
 if __name__ == "__main__":
     main()